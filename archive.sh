@@ -24,15 +24,16 @@ find archive/ -maxdepth 1 -type d -print0 | while IFS= read -r -d $'\0' dir; do
 
     # Archive the directory if it's older than the threshold
     if [ "$date_diff" -gt "$age_threshold" ]; then
-      # Create the archive file name
-      archive_file="${archive_dir}/${dir_name}.tar.gz"
+      # Create the archive file name. The archives inside are already zstd
+      # compressed, so the tarball isn't compressed again.
+      archive_file="${archive_dir}/${dir_name}.tar"
 
       # Check if the archive file already exists
       if [ -f "$archive_file" ]; then
         echo "Skipping existing archive: $archive_file"
       else
         # Create the archive
-        tar -czvf "$archive_file" "$dir"
+        tar -cvf "$archive_file" "$dir"
 
         # Check if the archive was created successfully
         if [ $? -eq 0 ]; then
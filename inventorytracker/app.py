@@ -1,12 +1,50 @@
-import json
+import atexit
+import httpx
 import os
-import requests
+import orjson
+import simdjson
 import sqlite3
+import sys
+import zstandard
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import socks
-import socket
 
-def get_inventory(start_index, search_key=None, archive_key=None):
+PAGE_SIZE = 100
+# Number of API requests kept in flight at once.
+FETCH_WORKERS = 20
+
+# cars columns compared against incoming data to log changes. Price,
+# inventory_date and mileage are tracked in their own tables instead.
+COMPARED_FIELDS = ('vin', 'make', 'model', 'year', 'city', 'state',
+                   'postal_code', 'inventory_type', 'link')
+
+# Route through a SOCKS5 proxy (host:port) if one is configured. socks5h
+# resolves hostnames through the proxy as well.
+socks5_proxy = os.environ.get('SOCKS5')
+
+# Shared by every fetch thread. HTTP/2 multiplexes the concurrent page
+# requests over the kept-alive TLS connection to hertzcarsales.com.
+_CLIENT = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=FETCH_WORKERS, max_keepalive_connections=FETCH_WORKERS),
+    proxy=f'socks5h://{socks5_proxy}' if socks5_proxy else None,
+    timeout=30,
+    follow_redirects=True,
+)
+atexit.register(_CLIENT.close)
+
+# Kept open for the whole run rather than reopened for every change, and
+# flushed after each page is committed
+_CHANGE_LOG = open('changes.log', 'a', buffering=1 << 16)
+atexit.register(_CHANGE_LOG.close)
+
+# Archives are only ever appended to, so they are stored compressed. Only
+# the main thread writes archives, so one compressor is enough.
+_ARCHIVE_COMPRESSOR = zstandard.ZstdCompressor(level=3)
+
+
+def get_inventory(start_index, archive_key=None):
     """Gets a single page of inventory from the Hertz Car Sales API.
 
     Args:
@@ -16,57 +54,88 @@ def get_inventory(start_index, search_key=None, archive_key=None):
     Returns:
         A list of dictionaries, where each dictionary represents a car.
     """
-    url = f"https://www.hertzcarsales.com/apis/widget/INVENTORY_LISTING_GRID_AUTO_ALL:inventory-data-bus1/getInventory?geoRadius=0&geoZip=78701&sortBy=inventoryDate%20asc&start={start_index}&pageSize=100"
-
-    if search_key:
-        url += f"&search={search_key}"
-
-    socks5_proxy = os.environ.get('SOCKS5')
-    if socks5_proxy:
-        proxy_ip, proxy_port = socks5_proxy.split(':')
-        socks.set_default_proxy(socks.SOCKS5, proxy_ip, int(proxy_port))
-        socket.socket = socks.socksocket
-        response = requests.get(url)
-    else:
-        response = requests.get(url)
+    url = f"https://www.hertzcarsales.com/apis/widget/INVENTORY_LISTING_GRID_AUTO_ALL:inventory-data-bus1/getInventory?geoRadius=0&geoZip=78701&sortBy=inventoryDate%20asc&start={start_index}&pageSize={PAGE_SIZE}"
 
+    response = _CLIENT.get(url)
     response.raise_for_status()
 
-    data = response.json()
-    inventory = data['inventory']
-    tracking_data = data['pageInfo']['trackingData']
+    # Only materialize the two parts of the response we use. A parser holds
+    # one document and refuses to parse again while proxies into it are
+    # alive, which a failed page's traceback can keep around, so each call
+    # gets its own; that's cheap next to the HTTP round-trip.
+    doc = simdjson.Parser().parse(response.content)
+    inventory = doc['inventory'].as_list()
+    tracking_data = doc.at_pointer('/pageInfo/trackingData').as_list()
 
-    cars = []
-    for i, car in enumerate(inventory):
-        combined_car = car.copy()
-        if i < len(tracking_data):
-            combined_car.update(tracking_data[i])
-        cars.append(combined_car)
+    # The parsed dicts aren't shared with anything, so merge each car's
+    # tracking data into it in place rather than into a copy
+    for car, tracking in zip(inventory, tracking_data):
+        car.update(tracking)
 
-    return cars
+    return inventory
 
 
-def get_cars(vin):
-    inventory = get_inventory(0, vin)
-    return inventory
+def get_all_inventory(executor):
+    """Yields every page of inventory in order.
 
+    The total page count isn't known up front, so FETCH_WORKERS pages are
+    kept in flight speculatively. The next page is requested as soon as one
+    is taken off the queue, so fetching carries on while the caller stores
+    the page, and the scan stops at the first empty page.
 
-def log_changes(uuid, field, old_value, new_value):
+    Args:
+        executor: The thread pool used to fetch pages concurrently.
+    """
+    pending = deque()
+    next_start = 0
+
+    def prefetch():
+        nonlocal next_start
+        pending.append((next_start, executor.submit(get_inventory, next_start)))
+        next_start += PAGE_SIZE
+
+    for _ in range(FETCH_WORKERS):
+        prefetch()
+
+    try:
+        while True:
+            start_index, future = pending.popleft()
+            prefetch()
+            cars = future.result()
+            print(start_index, len(cars))
+            if not cars:
+                return  # Stop if we get a page with no cars
+            yield cars
+    finally:
+        # Drop the speculative fetches past the end of the inventory
+        for _, future in pending:
+            future.cancel()
+
+
+def log_changes(uuid, field, old_value, new_value, now):
     """Logs changes to a file and prints to stdout."""
-    message = f"[{datetime.now()}] Change detected for {uuid}: {field} changed from '{old_value}' to '{new_value}'"
+    message = f"[{now}] Change detected for {uuid}: {field} changed from '{old_value}' to '{new_value}'"
     print(message)
-    with open('changes.log', 'a') as f:
-        f.write(message + '\n')
+    _CHANGE_LOG.write(message + '\n')
 
 
-def store_cars(cars):
-    """Stores car data into a SQLite database.
+def _connect():
+    """Opens the inventory database, tuned for a single bulk writer."""
+    conn = sqlite3.connect('hertz_inventory.db')
+    # WAL with synchronous=NORMAL only fsyncs on checkpoint rather than
+    # twice per commit
+    conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-65536;
+        PRAGMA mmap_size=268435456;
+    ''')
+    return conn
 
-    Args:
-        cars: A list of dictionaries, where each dictionary represents a car.
-    """
 
-    conn = sqlite3.connect('hertz_inventory.db')
+def create_tables(conn):
+    """Creates the inventory tables if they don't already exist."""
     cursor = conn.cursor()
 
     # Create tables if they don't exist, updated with new columns
@@ -118,51 +187,101 @@ def store_cars(cars):
         )
     ''')
 
-    for car in cars:
-        store_car(car, cursor)
+    # Cars still in inventory that the last scan didn't see
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS car_misses (
+            uuid TEXT PRIMARY KEY,
+            first_missed TEXT,
+            FOREIGN KEY (uuid) REFERENCES cars (uuid)
+        )
+    ''')
+
+    # Partial index so finding cars still in inventory isn't a full scan
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cars_removal ON cars (removal_date)
+        WHERE removal_date IS NULL
+    ''')
+
+    # Per-connection staging area for the page being stored, with the same
+    # column types as cars so comparisons between the two line up
+    cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS staging (
+            uuid TEXT,
+            vin TEXT,
+            price REAL,
+            make TEXT,
+            model TEXT,
+            year INTEGER,
+            mileage INTEGER,
+            city TEXT,
+            state TEXT,
+            postal_code TEXT,
+            inventory_date TEXT,
+            inventory_type TEXT,
+            link TEXT
+        )
+    ''')
 
     conn.commit()
-    conn.close()
 
 
-def store_car(car, cursor):
-    uuid = car['uuid']
-    vin = car['vin']
-    make = car['make']
-    model = car['model']
-    year = car['year']
-    mileage = int(car['odometer'])
-    price = car["internetPrice"]
-    city = car['address']['city']
-    state = car['address']['state']
-    postal_code = car['address']['postalCode']
-    inventory_date = car['inventoryDate']
-    inventory_type = car['inventoryType']
-    link = car['link']
+def store_cars(cars, conn):
+    """Stores car data into a SQLite database.
 
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    Args:
+        cars: A list of dictionaries, where each dictionary represents a car.
+        conn: The open database connection.
+    """
+    cursor = conn.cursor()
+    upsert_cars(cars, cursor)
+    conn.commit()
+
+    # Flush the page's change log lines along with its commit, so a killed
+    # run doesn't keep the changes but lose their log
+    _CHANGE_LOG.flush()
+    sys.stdout.flush()
 
-    # Check if the car exists
-    cursor.execute("SELECT * FROM cars WHERE uuid=?", (uuid,))
-    existing_car = cursor.fetchone()
 
-    if existing_car:
-        # Compare values (excluding price) and log changes
-        for i, field in enumerate(
-            ['uuid', 'vin', 'price', 'make', 'model', 'year', 'mileage',
-             'city', 'state', 'postal_code', 'inventory_date',
-             'inventory_type', 'link']
-        ):
-            if field in ['price', 'inventory_date', 'mileage']:
-                continue
+def upsert_cars(cars, cursor):
+    """Writes a batch of cars along with their price, inventory date and
+    mileage history.
 
-            if existing_car[i] != locals()[field]:
-                log_changes(uuid, field, existing_car[i], locals()[field])
+    Args:
+        cars: A list of dictionaries, where each dictionary represents a car.
+        cursor: The cursor to write with.
+    """
+    if not cars:
+        return
+
+    cursor.execute("DELETE FROM staging")
+    cursor.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [car_row(car) for car in cars])
+
+    # Seconds resolution is coarser than the time spent on a page, so one
+    # timestamp serves the whole batch
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    # Let SQLite compare the batch against the stored cars so only the
+    # changed ones come back
+    old_columns = ', '.join(f'c.{field}' for field in COMPARED_FIELDS)
+    new_columns = ', '.join(f's.{field}' for field in COMPARED_FIELDS)
+    changed = ' OR '.join(f'c.{field} IS NOT s.{field}' for field in COMPARED_FIELDS)
+    cursor.execute(f"SELECT s.uuid, {old_columns}, {new_columns} "
+                   f"FROM staging s JOIN cars c USING (uuid) WHERE {changed}")
+    for row in cursor.fetchall():
+        uuid = row[0]
+        old_values = row[1:len(COMPARED_FIELDS) + 1]
+        new_values = row[len(COMPARED_FIELDS) + 1:]
+        for field, old_value, new_value in zip(COMPARED_FIELDS, old_values, new_values):
+            if old_value != new_value:
+                log_changes(uuid, field, old_value, new_value, now)
 
     # Insert or update car data, preserving first_seen
     cursor.execute('''
         INSERT INTO cars (uuid, vin, price, make, model, year, mileage, city, state, postal_code, inventory_date, inventory_type, link, first_seen, last_seen, removal_date)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        SELECT uuid, vin, price, make, model, year, mileage, city, state, postal_code, inventory_date, inventory_type, link, ?, ?, NULL
+        FROM staging
+        WHERE true
         ON CONFLICT(uuid) DO UPDATE SET 
             vin = excluded.vin,
             price = excluded.price,
@@ -178,104 +297,112 @@ def store_car(car, cursor):
             link = excluded.link,
             last_seen = excluded.last_seen,
             removal_date = excluded.removal_date
-    ''', (uuid, vin, price, make, model, year, mileage, city, state, postal_code, inventory_date, inventory_type, link, now, now, None))
+    ''', (now, now))
 
     # Insert price data into car_prices table
     cursor.execute('''
         INSERT INTO car_prices (uuid, price)
-        VALUES (?, ?)
-    ''', (uuid, price))
+        SELECT uuid, price FROM staging
+    ''')
 
     # Insert inventory_date data into car_inventory_dates table
     cursor.execute('''
         INSERT INTO car_inventory_dates (uuid, inventory_date)
-        VALUES (?, ?)
-    ''', (uuid, inventory_date))
+        SELECT uuid, inventory_date FROM staging
+    ''')
 
     # Insert mileage data into car_mileages table
     cursor.execute('''
         INSERT INTO car_mileages (uuid, mileage)
-        VALUES (?, ?)
-    ''', (uuid, mileage))
+        SELECT uuid, mileage FROM staging
+    ''')
 
 
-def check_and_update_car(uuid, file_prefix):
-    """
-    Checks if a car is in inventory and updates the database accordingly.
+def car_row(car):
+    """Builds the staging table row for a car.
 
     Args:
-        vin: The VIN of the car to check.
-    """
-    conn = sqlite3.connect('hertz_inventory.db')
-    cursor = conn.cursor()
-
-    # Get the car's VIN from the database
-    cursor.execute("SELECT vin FROM cars WHERE uuid=?", (uuid,))
-    vin = cursor.fetchone()[0]
-
-    potential_cars = get_cars(vin)
-    archive_cars(file_prefix, potential_cars, 'by_vin')
-    # Get the car from the list with a matching uuid
-    car = next((car for car in potential_cars if car['uuid'] == uuid), None)
-
-    if car:
-        # Car is in inventory, store/update it
-        store_car(car, cursor)
-    else:
-        # Car is not in inventory, set removal_date
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute('''
-            UPDATE cars
-            SET removal_date = ?
-            WHERE uuid = ?
-        ''', (now, uuid))
+        car: A dictionary representing a car.
 
-    conn.commit()
-    conn.close()
+    Returns:
+        A tuple of values in cars table column order, without the
+        first_seen, last_seen and removal_date timestamps.
+    """
+    return (
+        car['uuid'],
+        car['vin'],
+        car["internetPrice"],
+        car['make'],
+        car['model'],
+        car['year'],
+        int(car['odometer']),
+        car['address']['city'],
+        car['address']['state'],
+        car['address']['postalCode'],
+        car['inventoryDate'],
+        car['inventoryType'],
+        car['link'],
+    )
 
 
 def archive_cars(file_prefix, cars, name):
-    """Appends cars to the JSON archive file."""
-    filename = f'{file_prefix}/{name}.txt'
-    with open(filename, 'a') as f:  # Open in append mode
-        for car in cars:
-            json.dump(car, f)
-            f.write('\n')  # Separate each car with a newline
+    """Appends cars to the zstd-compressed JSON archive file."""
+    filename = f'{file_prefix}/{name}.txt.zst'
+    # Serialize the whole page up front so it lands in a single write, with
+    # each car on its own line
+    buf = b''.join(orjson.dumps(car, option=orjson.OPT_APPEND_NEWLINE) for car in cars)
+    # Each call appends a separate zstd frame; `zstd -d` reads the
+    # concatenated frames back as one newline-delimited file
+    with open(filename, 'ab') as f:  # Open in append mode
+        f.write(_ARCHIVE_COMPRESSOR.compress(buf))
 
 
 def main():
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     file_prefix = f"archive/{timestamp}"
     os.makedirs(file_prefix, exist_ok=True)
-    start_index = 0
-    encountered_uuids = set()
 
-    while True:
-        cars = get_inventory(start_index)
-        print(start_index, len(cars))
-        if not cars:
-            break  # Stop if we get a page with no cars
+    conn = _connect()
+    create_tables(conn)
+    cursor = conn.cursor()
 
-        for car in cars:
-            encountered_uuids.add(car['uuid'])
+    # UUIDs seen during this scan, kept in SQLite so the removal check can
+    # be answered with a single query
+    cursor.execute("CREATE TEMP TABLE encountered (uuid TEXT PRIMARY KEY)")
 
-        archive_cars(file_prefix, cars, "paginated_scan")
-        store_cars(cars)
-        start_index += 100
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for cars in get_all_inventory(executor):
+            cursor.executemany("INSERT OR IGNORE INTO encountered (uuid) VALUES (?)",
+                               [(car['uuid'],) for car in cars])
 
-    # Get UUIDs from the database that don't have a removal date
-    conn = sqlite3.connect('hertz_inventory.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT uuid FROM cars WHERE removal_date IS NULL")
-    db_uuids = set(row[0] for row in cursor.fetchall())
-    conn.close()
+            archive_cars(file_prefix, cars, "paginated_scan")
+            store_cars(cars, conn)
 
-    # Calculate potential removed VINs
-    potential_removed_uuids = db_uuids - encountered_uuids
-    print(f"Potential removed UUIDs: {len(potential_removed_uuids)}. Checking each now..")
-    for uuid in potential_removed_uuids:
-        print(f"Checking car with UUID {uuid}")
-        check_and_update_car(uuid, file_prefix)
+    # Pages are fetched by offset, so a car can fall between two pages when
+    # another car is removed mid-scan. A car is only marked removed once it
+    # has been missing from two scans in a row, dated from its first miss.
+    cursor.execute('''
+        UPDATE cars
+        SET removal_date = (SELECT first_missed FROM car_misses m WHERE m.uuid = cars.uuid)
+        WHERE removal_date IS NULL
+            AND uuid IN (SELECT uuid FROM car_misses)
+            AND uuid NOT IN (SELECT uuid FROM encountered)
+    ''')
+    print(f"Removed UUIDs: {cursor.rowcount}")
+
+    # Remember this scan's misses for the next run
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute("DELETE FROM car_misses")
+    cursor.execute('''
+        INSERT INTO car_misses (uuid, first_missed)
+        SELECT uuid, ? FROM cars
+        WHERE removal_date IS NULL
+            AND uuid NOT IN (SELECT uuid FROM encountered)
+    ''', (now,))
+    print(f"Potential removed UUIDs: {cursor.rowcount}. Checking again next run..")
+    conn.commit()
+
+    conn.close()
 
 if __name__ == "__main__":
     main()